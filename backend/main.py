@@ -5,17 +5,21 @@ EscalateAI Backend - FastAPI application for complaint generation (OpenRouter)
 import os
 import logging
 import uuid
-from typing import Optional
+from typing import Any, AsyncIterator, Optional
 from enum import Enum
-import json
 import asyncio
-import re
+import hashlib
+import random
+import time
 
 import httpx
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
 
 # -----------------------------
 # Load environment variables
@@ -35,7 +39,11 @@ logger = logging.getLogger("escalateai")
 # -----------------------------
 # FastAPI App
 # -----------------------------
-app = FastAPI(title="EscalateAI API", version="1.0.0")
+app = FastAPI(
+    title="EscalateAI API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 # CORS (allow all for dev)
 app.add_middleware(
@@ -99,6 +107,76 @@ class GenerateResponse(BaseModel):
     required_placeholders: list[str]
 
 
+class ModelOutput(BaseModel):
+    """
+    Parsed model answer with defaults for missing (or null) fields.
+    Subjects default to None so the caller can derive them from the request title.
+    """
+
+    whatsapp_message: str = "No message generated"
+    email_subject: Optional[str] = None
+    email_body: str = "No email body generated"
+    escalation_subject: Optional[str] = None
+    escalation_body: str = "No escalation body generated"
+    followup_message: str = "No follow-up message generated"
+    tips: list[str] = Field(
+        default_factory=lambda: [
+            "Review the message before sending.",
+            "Keep proof documents ready (screenshots, receipts, emails).",
+        ]
+    )
+
+    @model_validator(mode="before")
+    @classmethod
+    def _drop_nulls(cls, data):
+        if isinstance(data, dict):
+            return {k: v for k, v in data.items() if v is not None}
+        return data
+
+    @field_validator("tips", mode="before")
+    @classmethod
+    def _coerce_tips(cls, v):
+        if isinstance(v, list):
+            return v
+        return [str(v)] if v else []
+
+
+# Fields the model is expected to produce (server-side fields excluded)
+MODEL_OUTPUT_FIELDS = frozenset(GenerateResponse.model_fields) - {"request_id", "required_placeholders"}
+
+
+def _model_output_schema() -> dict:
+    """
+    JSON schema for the model's answer: GenerateResponse minus server-side fields,
+    in the strict form required by structured outputs (all keys required, no extras).
+    """
+    schema = GenerateResponse.model_json_schema()
+    properties = {k: v for k, v in schema["properties"].items() if k in MODEL_OUTPUT_FIELDS}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+# Structured-output request; models without support fall back to the _extract_json scan
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "complaint", "strict": True, "schema": _model_output_schema()},
+}
+
+
+# Optional request fields -> placeholder used in drafts when the field is missing
+PLACEHOLDER_FIELDS = (
+    ("incident_date", "DATE"),
+    ("location", "LOCATION"),
+    ("company_or_institution", "COMPANY_NAME"),
+    ("recipient_name", "RECIPIENT_NAME"),
+    ("order_or_ticket_id", "ORDER_ID"),
+)
+
+
 # -----------------------------
 # OpenRouter Config
 # -----------------------------
@@ -108,10 +186,95 @@ OPENROUTER_MODEL_FALLBACK = os.getenv(
     "OPENROUTER_MODEL_FALLBACK", "meta-llama/llama-3.1-8b-instruct"
 )
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Generation settings: the 7-field JSON needs ~400-600 tokens, so cap well above that
+OPENROUTER_MAX_TOKENS = int(os.getenv("OPENROUTER_MAX_TOKENS", "800"))
+OPENROUTER_TEMPERATURE = float(os.getenv("OPENROUTER_TEMPERATURE", "0.3"))
+
+# Model outputs longer than this (chars) are parsed in a worker thread to keep the event loop free
+EXTRACT_OFFLOAD_THRESHOLD = 4096
+
+# Upstream statuses worth retrying; anything else in 4xx fails fast
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+# Longest wait between attempts; a larger Retry-After ends retries so the fallback model is used
+MAX_BACKOFF_SECONDS = 6.0
+
+# Circuit breaker: trip after N consecutive failed attempts, fast-fail during cooldown
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "30"))
+
+# Start the fallback model if the primary hasn't answered within this delay (large value disables hedging)
+HEDGE_DELAY_MS = float(os.getenv("HEDGE_DELAY_MS", "2000"))
+
+# Max concurrent upstream calls; excess requests queue here instead of tripping provider 429s
+OPENROUTER_CONCURRENCY = int(os.getenv("OPENROUTER_CONCURRENCY", "20"))
+_openrouter_sem = asyncio.Semaphore(OPENROUTER_CONCURRENCY)
+
+# Connection pool sizing for the shared client (size to your OpenRouter rate-limit tier)
+HTTPX_MAX_CONNECTIONS = int(os.getenv("HTTPX_MAX_CONNECTIONS", "200"))
+HTTPX_MAX_KEEPALIVE = int(os.getenv("HTTPX_MAX_KEEPALIVE", "100"))
+
 if not OPENROUTER_API_KEY:
     logger.warning("OPENROUTER_API_KEY not set. API will not work properly.")
 
 
+# -----------------------------
+# Response Cache
+# -----------------------------
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "1024"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "3600"))
+
+# Mark static prompt blocks with cache_control so supporting providers reuse their KV cache.
+# Off by default: models that don't accept content-part arrays / cache_control may reject it.
+ENABLE_PROMPT_CACHE = os.getenv("ENABLE_PROMPT_CACHE", "false").lower() in ("1", "true", "yes")
+
+# Exact-match cache of generated drafts keyed by the normalized request context
+_response_cache: TTLCache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL_SECONDS)
+
+# In-flight generations keyed like the cache; identical concurrent requests share one upstream call
+_inflight: dict[str, asyncio.Task] = {}
+
+
+# -----------------------------
+# Shared HTTP Client
+# -----------------------------
+# Sent on every OpenRouter call; set once as client defaults
+_STATIC_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    # Optional headers recommended by OpenRouter
+    "HTTP-Referer": "http://localhost:3000",
+    "X-Title": "EscalateAI",
+}
+
+
+@app.on_event("startup")
+async def startup_http_client():
+    """Create one pooled client so keep-alive connections are reused across requests."""
+    app.state.http = httpx.AsyncClient(
+        http2=True,  # multiplex concurrent /generate calls over few connections
+        timeout=httpx.Timeout(connect=10.0, read=60.0, write=10.0, pool=10.0),
+        limits=httpx.Limits(
+            max_connections=HTTPX_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTPX_MAX_KEEPALIVE,
+            keepalive_expiry=30.0,
+        ),
+        headers=_STATIC_HEADERS,
+    )
+    logger.info(
+        f"HTTP client ready max_connections={HTTPX_MAX_CONNECTIONS} "
+        f"max_keepalive_connections={HTTPX_MAX_KEEPALIVE} "
+        f"api_key_configured={bool(OPENROUTER_API_KEY)}"
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    await app.state.http.aclose()
+
+
 # -----------------------------
 # System Prompt
 # -----------------------------
@@ -137,81 +300,524 @@ Output Rules:
   whatsapp_message, email_subject, email_body, escalation_subject, escalation_body, followup_message, tips
 """
 
+# Static part of the user prompt, identical for every request (cacheable upstream)
+PROMPT_INSTRUCTIONS = """
+Generate professional complaint drafts for the scenario below.
+
+Return valid JSON with these keys:
+1) whatsapp_message (short and clear)
+2) email_subject
+3) email_body
+4) escalation_subject
+5) escalation_body
+6) followup_message
+7) tips (2 to 4 short actionable tips)
+"""
+
+# Per-request part of the user prompt; filled with PROMPT_TEMPLATE.format_map(context)
+PROMPT_TEMPLATE = """
+Scenario:
+
+Category: {category}
+Tone: {tone}
+
+Title: {title}
+Description: {description}
+
+Incident Date: {incident_date}
+Location: {location}
+Company/Institution: {company_or_institution}
+Recipient Name: {recipient_name}
+Order/Ticket ID: {order_or_ticket_id}
+Desired Resolution: {desired_resolution}
+Proof Available: {proof_available}
+"""
+
 
 # -----------------------------
 # Helpers
 # -----------------------------
+def _retry_after_seconds(resp: httpx.Response) -> float:
+    """
+    Parse a numeric Retry-After header (seconds). Returns 0.0 when absent or unparseable.
+    """
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After", 0)))
+    except ValueError:
+        return 0.0
+
+
+def _cache_key(context: dict) -> str:
+    """
+    Stable hash of the prompt context; identical requests map to the same key.
+    """
+    raw = orjson.dumps(context, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _find_json_span(t: str) -> tuple[int, int]:
+    """
+    Single left-to-right scan for the first balanced JSON object in t.
+    Braces inside string literals are ignored. Returns (start, end) for slicing.
+    """
+    start = -1
+    depth = 0
+    in_str = False
+    esc = False
+
+    for i, c in enumerate(t):
+        if start == -1:
+            if c == "{":
+                start = i
+                depth = 1
+            continue
+
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+
+    raise orjson.JSONDecodeError("No JSON object found in model output", t, max(start, 0))
+
+
+def _is_complete_output(parsed: dict) -> bool:
+    """
+    True when the model supplied every expected field, i.e. nothing in the
+    response came from fallback defaults. Only complete answers are cached.
+    """
+    return all(parsed.get(k) is not None for k in MODEL_OUTPUT_FIELDS)
+
+
 def _extract_json(text: str) -> dict:
     """
     Extract the first JSON object from model output.
-    Handles cases where model adds extra text or ```json fences.
+    Handles cases where model adds extra text or ```json fences (anything before
+    the first '{' or after its matching '}' is skipped).
     """
     t = (text or "").strip()
 
-    # Remove code fences if present
-    if t.startswith("```"):
-        t = re.sub(r"^```(?:json)?\s*", "", t, flags=re.IGNORECASE).strip()
-        t = re.sub(r"\s*```$", "", t).strip()
+    # Fast path: model honoured JSON mode and returned a bare object
+    if t.startswith("{"):
+        try:
+            return orjson.loads(t)
+        except orjson.JSONDecodeError:
+            pass
+
+    start, end = _find_json_span(t)
+    return orjson.loads(t[start:end])
+
+
+# Invariant message parts, built once at import
+if ENABLE_PROMPT_CACHE:
+    _SYSTEM_MSG = {
+        "role": "system",
+        "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    }
+    _INSTRUCTIONS_PART = {"type": "text", "text": PROMPT_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}
+else:
+    _SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Payload fields shared by every call; per-call payloads add model/messages
+_PAYLOAD_BASE = {
+    "temperature": OPENROUTER_TEMPERATURE,
+    "max_tokens": OPENROUTER_MAX_TOKENS,
+    "response_format": RESPONSE_FORMAT,
+}
+
+
+def _parse_model_output(text: str) -> dict:
+    """
+    Extract and validate the model's answer. Returns only the fields the model
+    supplied (normalized), so callers can tell complete answers from partial ones.
+    Raises ValueError (JSONDecodeError / ValidationError) on unusable output.
+    """
+    return ModelOutput.model_validate(_extract_json(text)).model_dump(exclude_unset=True)
+
+
+def _build_messages(prompt: str) -> list[dict]:
+    """
+    Chat messages for a rendered PROMPT_TEMPLATE. With ENABLE_PROMPT_CACHE the
+    system prompt and PROMPT_INSTRUCTIONS are sent as cache_control text blocks.
+    """
+    if not ENABLE_PROMPT_CACHE:
+        return [_SYSTEM_MSG, {"role": "user", "content": PROMPT_INSTRUCTIONS + prompt}]
 
-    start = t.find("{")
-    end = t.rfind("}")
+    return [
+        _SYSTEM_MSG,
+        {"role": "user", "content": [_INSTRUCTIONS_PART, {"type": "text", "text": prompt}]},
+    ]
 
-    if start == -1 or end == -1 or end <= start:
-        raise json.JSONDecodeError("No JSON object found in model output", t, 0)
 
-    return json.loads(t[start : end + 1])
+class _JsonFieldStream:
+    """
+    Incremental parser for a single top-level JSON object fed in text chunks.
+    feed() returns the (key, value) members that completed in that chunk, so
+    callers can act on each field as soon as the model finishes writing it.
+    Text before the first '{' (prose, ```json fences) and after the closing '}' is ignored.
+    `text` holds everything fed so far; `complete` is set once the object closes.
+    """
 
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._member_start = 0
+        self.complete = False
+
+    def feed(self, chunk: str) -> list[tuple[str, Any]]:
+        self.text += chunk
+        members = []
+
+        for i in range(self._pos, len(self.text)):
+            if self.complete:
+                break
+            c = self.text[i]
+
+            if self._depth == 0:
+                if c == "{":
+                    self._depth = 1
+                    self._member_start = i + 1
+                continue
+
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+            elif c == '"':
+                self._in_str = True
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                if self._depth == 1:
+                    members.extend(self._member(i))
+                    self.complete = True
+                self._depth -= 1
+            elif c == "," and self._depth == 1:
+                members.extend(self._member(i))
+                self._member_start = i + 1
+
+        self._pos = len(self.text)
+        return members
+
+    def _member(self, end: int) -> list[tuple[str, Any]]:
+        segment = self.text[self._member_start : end].strip()
+        if not segment:
+            return []
+        return list(orjson.loads("{" + segment + "}").items())
+
+
+class Breaker:
+    """
+    Per-model circuit breaker (closed -> open -> half_open -> closed).
+    Failures are counted per upstream attempt, so calls cancelled mid-retry
+    (e.g. a hedged primary that lost the race) still count. While open, calls
+    fail immediately so the next model is tried without waiting on
+    retries/timeouts. After the cooldown a single probe call is let through.
+    """
 
-async def call_openrouter(prompt: str, model: str, max_retries: int = 2) -> dict:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_open_lock = asyncio.Lock()
+
+    async def before_call(self) -> None:
+        async with self.half_open_lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                return
+            raise RuntimeError("breaker open")
+
+    async def record_success(self) -> None:
+        async with self.half_open_lock:
+            self.state = "closed"
+            self.failures = 0
+
+    async def record_failure(self) -> None:
+        async with self.half_open_lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    async def release_probe(self) -> None:
+        # Probe ended without a verdict on upstream health; allow the next caller to probe
+        async with self.half_open_lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+
+async def call_openrouter(
+    client: httpx.AsyncClient,
+    prompt: str,
+    model: str,
+    max_retries: int = 3,
+    breaker: Optional[Breaker] = None,
+) -> dict:
     """
-    Calls OpenRouter Chat Completions API and returns parsed JSON dict.
-    Includes retries with exponential backoff.
+    Calls OpenRouter Chat Completions API and returns the validated model output
+    (see _parse_model_output).
+    Retries transient failures (429/5xx, timeouts, connection errors, malformed or invalid output)
+    with full-jitter exponential backoff; other HTTP errors fail immediately.
+    Each transient failure is reported to `breaker`, and retries stop once it opens.
     """
     if not OPENROUTER_API_KEY:
         raise RuntimeError("OPENROUTER_API_KEY not configured")
 
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        # Optional headers recommended by OpenRouter
-        "HTTP-Referer": "http://localhost:3000",
-        "X-Title": "EscalateAI",
-    }
+    body = orjson.dumps({**_PAYLOAD_BASE, "model": model, "messages": _build_messages(prompt)})
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt},
-        ],
-        "temperature": 0.7,
-    }
+    last_err = None
 
-    timeout = httpx.Timeout(connect=10.0, read=60.0, write=10.0, pool=10.0)
+    for attempt in range(max_retries):
+        retry_after = 0.0
+        try:
+            if _openrouter_sem.locked():
+                logger.debug(f"OpenRouter concurrency limit ({OPENROUTER_CONCURRENCY}) reached; queueing model={model}")
+            async with _openrouter_sem:
+                resp = await client.post(OPENROUTER_URL, content=body)
+            logger.debug(f"OpenRouter response via {resp.http_version} model={model}")
+
+            if resp.status_code >= 400:
+                logger.error(f"OpenRouter HTTP {resp.status_code}: {resp.text[:800]}")
+                resp.raise_for_status()
+
+            data = orjson.loads(resp.content)
+            text = data["choices"][0]["message"]["content"]
+            if len(text) > EXTRACT_OFFLOAD_THRESHOLD:
+                return await asyncio.to_thread(_parse_model_output, text)
+            return _parse_model_output(text)
+
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in RETRYABLE_STATUS_CODES:
+                # Rejected request (bad payload, moderation), not an unhealthy model
+                if breaker is not None:
+                    await breaker.release_probe()
+                raise
+            if breaker is not None:
+                await breaker.record_failure()
+            last_err = e
+            retry_after = _retry_after_seconds(e.response)
+        except (httpx.TransportError, ValueError, KeyError, IndexError, TypeError) as e:
+            # Timeouts / connect / protocol errors, or malformed model output
+            if breaker is not None:
+                await breaker.record_failure()
+            last_err = e
+        except Exception:
+            if breaker is not None:
+                await breaker.release_probe()
+            raise
+
+        logger.warning(f"OpenRouter call failed (attempt {attempt+1}/{max_retries}) model={model}: {last_err}")
+        if breaker is not None and breaker.state == "open":
+            raise RuntimeError(f"breaker open (model={model})") from last_err
+        if retry_after > MAX_BACKOFF_SECONDS:
+            logger.warning(f"OpenRouter Retry-After {retry_after:.0f}s exceeds cap; not retrying model={model}")
+            break
+        if attempt + 1 < max_retries:
+            backoff = random.uniform(0, min(MAX_BACKOFF_SECONDS, 0.8 * (2**attempt)))
+            await asyncio.sleep(max(backoff, retry_after))
 
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        last_err = None
+    raise RuntimeError(f"OpenRouter failed after retries (model={model})") from last_err
 
-        for attempt in range(max_retries):
-            try:
-                resp = await client.post(url, headers=headers, json=payload)
 
-                if resp.status_code >= 400:
-                    logger.error(f"OpenRouter HTTP {resp.status_code}: {resp.text[:800]}")
-                    resp.raise_for_status()
+async def stream_openrouter(
+    client: httpx.AsyncClient, prompt: str, model: str
+) -> AsyncIterator[tuple[str, Any]]:
+    """
+    Calls OpenRouter with stream=True and yields (key, value) for each top-level
+    JSON field as soon as it is complete. No retries: a partially streamed answer
+    cannot be replayed, so failures surface to the caller for fallback.
+    """
+    if not OPENROUTER_API_KEY:
+        raise RuntimeError("OPENROUTER_API_KEY not configured")
 
-                data = resp.json()
-                text = data["choices"][0]["message"]["content"]
-                return _extract_json(text)
+    body = orjson.dumps(
+        {**_PAYLOAD_BASE, "model": model, "messages": _build_messages(prompt), "stream": True}
+    )
 
-            except Exception as e:
-                last_err = e
-                backoff = min(6.0, 0.8 * (2**attempt))
-                logger.warning(f"OpenRouter call failed (attempt {attempt+1}/{max_retries}) model={model}: {e}")
-                await asyncio.sleep(backoff)
+    parser = _JsonFieldStream()
+
+    if _openrouter_sem.locked():
+        logger.debug(f"OpenRouter concurrency limit ({OPENROUTER_CONCURRENCY}) reached; queueing model={model}")
+    async with _openrouter_sem, client.stream("POST", OPENROUTER_URL, content=body) as resp:
+        if resp.status_code >= 400:
+            await resp.aread()
+            logger.error(f"OpenRouter HTTP {resp.status_code}: {resp.text[:800]}")
+            resp.raise_for_status()
+
+        async for line in resp.aiter_lines():
+            # SSE: skip keep-alive comments (": OPENROUTER PROCESSING") and blank lines
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+
+            chunk = orjson.loads(data)
+            if "error" in chunk:
+                raise RuntimeError(f"OpenRouter stream error: {chunk['error']}")
+            choices = chunk.get("choices") or [{}]
+            delta = (choices[0].get("delta") or {}).get("content")
+            if not delta:
+                continue
+
+            for key, value in parser.feed(delta):
+                yield key, value
+            if parser.complete:
+                break
+
+    if not parser.complete:
+        raise orjson.JSONDecodeError("Incomplete JSON object in streamed model output", parser.text, 0)
+
+
+_breakers: dict[str, Breaker] = {}
+
+
+def _get_breaker(model: str) -> Breaker:
+    breaker = _breakers.get(model)
+    if breaker is None:
+        breaker = _breakers[model] = Breaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN_SECONDS)
+    return breaker
+
+
+async def call_with_breaker(client: httpx.AsyncClient, prompt: str, model: str) -> dict:
+    """
+    call_openrouter guarded by the model's circuit breaker.
+    Raises RuntimeError("breaker open") without calling upstream while tripped.
+    Failed attempts are recorded inside call_openrouter as they happen.
+    """
+    breaker = _get_breaker(model)
+
+    await breaker.before_call()
+    try:
+        result = await call_openrouter(client, prompt, model=model, breaker=breaker)
+    except asyncio.CancelledError:
+        # Only matters if no attempt failed yet: a failed probe already reopened the breaker
+        await breaker.release_probe()
+        raise
+
+    await breaker.record_success()
+    return result
+
+
+async def stream_with_breaker(
+    client: httpx.AsyncClient, prompt: str, model: str
+) -> AsyncIterator[tuple[str, Any]]:
+    """
+    stream_openrouter guarded by the model's circuit breaker.
+    The model only counts as healthy once its complete answer validates as ModelOutput.
+    """
+    breaker = _get_breaker(model)
+
+    await breaker.before_call()
+    try:
+        output = {}
+        async for key, value in stream_openrouter(client, prompt, model=model):
+            output.setdefault(key, value)
+            yield key, value
+        ModelOutput.model_validate(output)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code in RETRYABLE_STATUS_CODES:
+            await breaker.record_failure()
+        else:
+            # Rejected request (bad payload, moderation), not an unhealthy model
+            await breaker.release_probe()
+        raise
+    except (httpx.TransportError, ValueError, KeyError, IndexError, TypeError, RuntimeError):
+        # Connection/timeout errors, provider stream errors, malformed or invalid output
+        await breaker.record_failure()
+        raise
+    except BaseException:
+        # Cancelled / client disconnected / unexpected: no verdict on upstream health
+        await breaker.release_probe()
+        raise
+
+    await breaker.record_success()
+
+
+async def call_hedged(client: httpx.AsyncClient, prompt: str, request_id: str) -> dict:
+    """
+    Races the primary and fallback models. The primary gets a HEDGE_DELAY_MS head
+    start (skipped if it fails sooner); the first valid result wins and the other
+    call is cancelled. Raises the last error if both models fail.
+    """
+    logger.info(f"[{request_id}] Trying model={OPENROUTER_MODEL_PRIMARY}")
+    primary = asyncio.create_task(
+        call_with_breaker(client, prompt, model=OPENROUTER_MODEL_PRIMARY), name=OPENROUTER_MODEL_PRIMARY
+    )
+    pending = {primary}
+    last_error = None
+
+    try:
+        done, _ = await asyncio.wait(pending, timeout=HEDGE_DELAY_MS / 1000)
+        if primary in done:
+            if primary.exception() is None:
+                return primary.result()
+            last_error = primary.exception()
+            logger.warning(f"[{request_id}] Model failed model={OPENROUTER_MODEL_PRIMARY}: {last_error}")
+            pending = set()
+
+        logger.info(f"[{request_id}] Trying model={OPENROUTER_MODEL_FALLBACK}")
+        fallback = asyncio.create_task(
+            call_with_breaker(client, prompt, model=OPENROUTER_MODEL_FALLBACK), name=OPENROUTER_MODEL_FALLBACK
+        )
+        pending.add(fallback)
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                last_error = task.exception()
+                logger.warning(f"[{request_id}] Model failed model={task.get_name()}: {last_error}")
+    finally:
+        for task in pending:
+            task.cancel()
 
-        raise RuntimeError(f"OpenRouter failed after retries (model={model})") from last_err
+    raise RuntimeError("All models failed") from last_error
+
+
+def _inflight_done(key: str, task: asyncio.Task) -> None:
+    _inflight.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # mark retrieved even if every waiter went away
+
+
+async def call_coalesced(client: httpx.AsyncClient, prompt: str, cache_key: str, request_id: str) -> dict:
+    """
+    Single-flight wrapper around call_hedged: concurrent requests with the same
+    cache key await one shared upstream call. Waiters are shielded, so one client
+    disconnecting does not cancel the call for the others.
+    """
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(call_hedged(client, prompt, request_id))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda t: _inflight_done(cache_key, t))
+    else:
+        logger.info(f"[{request_id}] Joined in-flight request key={cache_key}")
+
+    return await asyncio.shield(task)
 
 
 # -----------------------------
@@ -224,9 +830,47 @@ async def health_check():
         "primary_model": OPENROUTER_MODEL_PRIMARY,
         "fallback_model": OPENROUTER_MODEL_FALLBACK,
         "api_key_configured": bool(OPENROUTER_API_KEY),
+        "httpx_max_connections": HTTPX_MAX_CONNECTIONS,
+        "httpx_max_keepalive": HTTPX_MAX_KEEPALIVE,
+        "openrouter_concurrency": OPENROUTER_CONCURRENCY,
+        "breakers": {model: b.state for model, b in _breakers.items()},
     }
 
 
+def _build_context(request: GenerateRequest) -> tuple[dict, list[str]]:
+    """
+    Prompt context for a request, with placeholders substituted for missing details.
+    Returns (context, required_placeholders).
+    """
+    context = request.model_dump(mode="json")
+    context["proof_available"] = bool(context["proof_available"])
+
+    required_placeholders = []
+    for attr, placeholder in PLACEHOLDER_FIELDS:
+        if not context[attr]:
+            required_placeholders.append(placeholder)
+            context[attr] = f"{{{{{placeholder}}}}}"
+
+    return context, required_placeholders
+
+
+def _build_response(
+    request_id: str, request: GenerateRequest, parsed: dict, required_placeholders: list[str]
+) -> GenerateResponse:
+    out = ModelOutput.model_validate(parsed)
+    return GenerateResponse(
+        **out.model_dump(exclude={"email_subject", "escalation_subject"}),
+        request_id=request_id,
+        email_subject=out.email_subject or f"Complaint Regarding: {request.title}",
+        escalation_subject=out.escalation_subject or f"Escalation: {request.title}",
+        required_placeholders=required_placeholders,
+    )
+
+
+def _ndjson(obj: dict) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+
 @app.post("/generate", response_model=GenerateResponse)
 async def generate_complaint(request: GenerateRequest):
     request_id = str(uuid.uuid4())
@@ -234,59 +878,15 @@ async def generate_complaint(request: GenerateRequest):
         f"[{request_id}] category={request.category.value} tone={request.tone.value} title={request.title[:60]}"
     )
 
-    # Placeholders logic
-    required_placeholders = []
-    if not request.incident_date:
-        required_placeholders.append("DATE")
-    if not request.location:
-        required_placeholders.append("LOCATION")
-    if not request.company_or_institution:
-        required_placeholders.append("COMPANY_NAME")
-    if not request.recipient_name:
-        required_placeholders.append("RECIPIENT_NAME")
-    if not request.order_or_ticket_id:
-        required_placeholders.append("ORDER_ID")
-
-    context = {
-        "category": request.category.value,
-        "tone": request.tone.value,
-        "title": request.title,
-        "description": request.description,
-        "incident_date": request.incident_date or "{{DATE}}",
-        "location": request.location or "{{LOCATION}}",
-        "company_or_institution": request.company_or_institution or "{{COMPANY_NAME}}",
-        "recipient_name": request.recipient_name or "{{RECIPIENT_NAME}}",
-        "order_or_ticket_id": request.order_or_ticket_id or "{{ORDER_ID}}",
-        "desired_resolution": request.desired_resolution,
-        "proof_available": bool(request.proof_available),
-    }
-
-    prompt = f"""
-Generate professional complaint drafts for the following scenario:
-
-Category: {context['category']}
-Tone: {context['tone']}
+    context, required_placeholders = _build_context(request)
 
-Title: {context['title']}
-Description: {context['description']}
+    cache_key = _cache_key(context)
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"[{request_id}] Cache hit key={cache_key}")
+        return GenerateResponse(request_id=request_id, **cached)
 
-Incident Date: {context['incident_date']}
-Location: {context['location']}
-Company/Institution: {context['company_or_institution']}
-Recipient Name: {context['recipient_name']}
-Order/Ticket ID: {context['order_or_ticket_id']}
-Desired Resolution: {context['desired_resolution']}
-Proof Available: {context['proof_available']}
-
-Return valid JSON with these keys:
-1) whatsapp_message (short and clear)
-2) email_subject
-3) email_body
-4) escalation_subject
-5) escalation_body
-6) followup_message
-7) tips (2 to 4 short actionable tips)
-"""
+    prompt = PROMPT_TEMPLATE.format_map(context)
 
     if not OPENROUTER_API_KEY:
         raise HTTPException(
@@ -294,62 +894,114 @@ Return valid JSON with these keys:
             detail="AI models are not available. Please check API configuration.",
         )
 
-    models_to_try = [OPENROUTER_MODEL_PRIMARY, OPENROUTER_MODEL_FALLBACK]
-
-    parsed = None
-    last_error = None
-
-    for model in models_to_try:
-        try:
-            logger.info(f"[{request_id}] Trying model={model}")
-            parsed = await call_openrouter(prompt, model=model)
-            break
-        except Exception as e:
-            last_error = e
-            logger.warning(f"[{request_id}] Model failed model={model}: {e}")
-
-    if parsed is None:
-        logger.error(f"[{request_id}] All models failed. Last error: {last_error}")
+    try:
+        parsed = await call_coalesced(app.state.http, prompt, cache_key, request_id)
+    except Exception as e:
+        logger.error(f"[{request_id}] All models failed. Last error: {e.__cause__ or e}")
         raise HTTPException(
             status_code=502,
             detail="Failed to generate complaint (all models failed). Please try again later.",
         )
 
-    # Extract fields with defaults
-    whatsapp_message = parsed.get("whatsapp_message", "No message generated")
-    email_subject = parsed.get("email_subject", f"Complaint Regarding: {request.title}")
-    email_body = parsed.get("email_body", "No email body generated")
-    escalation_subject = parsed.get("escalation_subject", f"Escalation: {request.title}")
-    escalation_body = parsed.get("escalation_body", "No escalation body generated")
-    followup_message = parsed.get("followup_message", "No follow-up message generated")
-    tips = parsed.get(
-        "tips",
-        [
-            "Review the message before sending.",
-            "Keep proof documents ready (screenshots, receipts, emails).",
-        ],
-    )
-
-    if not isinstance(tips, list):
-        tips = [str(tips)] if tips else []
+    response = _build_response(request_id, request, parsed, required_placeholders)
 
     logger.info(f"[{request_id}] Generated successfully")
-    return GenerateResponse(
-        request_id=request_id,
-        whatsapp_message=whatsapp_message,
-        email_subject=email_subject,
-        email_body=email_body,
-        escalation_subject=escalation_subject,
-        escalation_body=escalation_body,
-        followup_message=followup_message,
-        tips=tips,
-        required_placeholders=required_placeholders,
+    if _is_complete_output(parsed):
+        _response_cache[cache_key] = response.model_dump(exclude={"request_id"})
+    return response
+
+
+@app.post("/generate/stream")
+async def generate_complaint_stream(request: GenerateRequest):
+    """
+    Streaming variant of /generate. Emits NDJSON lines of the form
+    {"field": <name>, "value": <value>} as each field is produced, starting with
+    request_id and ending with required_placeholders. If a field needs a default or
+    normalization after the model finishes, it is re-sent and the later line wins.
+    On failure a final {"error": <detail>} line is emitted.
+    """
+    request_id = str(uuid.uuid4())
+    logger.info(
+        f"[{request_id}] stream category={request.category.value} tone={request.tone.value} title={request.title[:60]}"
     )
 
+    context, required_placeholders = _build_context(request)
+
+    cache_key = _cache_key(context)
+    cached = _response_cache.get(cache_key)
+
+    if cached is None and not OPENROUTER_API_KEY:
+        raise HTTPException(
+            status_code=503,
+            detail="AI models are not available. Please check API configuration.",
+        )
+
+    prompt = PROMPT_TEMPLATE.format_map(context)
+
+    async def events():
+        yield _ndjson({"field": "request_id", "value": request_id})
+
+        if cached is not None:
+            logger.info(f"[{request_id}] Cache hit key={cache_key}")
+            for key, value in cached.items():
+                yield _ndjson({"field": key, "value": value})
+            return
+
+        parsed = {}
+        last_error = None
+        succeeded = False
+
+        for model in [OPENROUTER_MODEL_PRIMARY, OPENROUTER_MODEL_FALLBACK]:
+            try:
+                logger.info(f"[{request_id}] Streaming model={model}")
+                async for key, value in stream_with_breaker(app.state.http, prompt, model=model):
+                    if key in MODEL_OUTPUT_FIELDS and key not in parsed:
+                        parsed[key] = value
+                        yield _ndjson({"field": key, "value": value})
+                succeeded = True
+                break
+            except Exception as e:
+                last_error = e
+                logger.warning(f"[{request_id}] Model failed model={model}: {e}")
+                # Fields already sent to the client cannot be mixed with another model's output
+                if parsed:
+                    break
+
+        if not succeeded:
+            logger.error(f"[{request_id}] Streaming failed. Last error: {last_error}")
+            if parsed:
+                # A model started answering, so no fallback was attempted
+                detail = "Failed to generate complaint (model output was interrupted or invalid). Please try again."
+            else:
+                detail = "Failed to generate complaint (all models failed). Please try again later."
+            yield _ndjson({"error": detail})
+            return
+
+        # Fill defaults / normalized values for anything the model omitted
+        try:
+            response = _build_response(request_id, request, parsed, required_placeholders)
+        except ValidationError as e:
+            logger.error(f"[{request_id}] Model output failed validation: {e}")
+            yield _ndjson({"error": "Failed to generate complaint (model output was invalid). Please try again."})
+            return
+
+        for key, value in response.model_dump(exclude={"request_id"}).items():
+            if parsed.get(key) != value:
+                yield _ndjson({"field": key, "value": value})
+
+        logger.info(f"[{request_id}] Generated successfully (stream)")
+        if _is_complete_output(parsed):
+            _response_cache[cache_key] = response.model_dump(exclude={"request_id"})
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 
 # -----------------------------
 # Local Run
 # -----------------------------
+# uvicorn's default loop="auto"/http="auto" already pick uvloop + httptools when installed
+# (uvicorn[standard]; uvloop is unavailable on Windows). For Linux container deploys use:
+#   uvicorn main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --workers 2
 if __name__ == "__main__":
     import uvicorn
 